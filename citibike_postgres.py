@@ -1,44 +1,97 @@
 import sys
 import os
 import csv
+import subprocess
+import tempfile
 import zipfile
 
-from StringIO import StringIO
+from datetime import date
+from distutils.spawn import find_executable
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 import boto3
 
 from botocore.handlers import disable_signing
 
 import psycopg2
-from psycopg2 import sql, extras
+from psycopg2 import sql, pool
+
+
+#Postgres types of the known columns of the citibike csv files
+
+TRIP_FACT_COLUMN_TYPES = {
+    "tripduration": "INTEGER",
+    "starttime": "TIMESTAMP",
+    "stoptime": "TIMESTAMP",
+    "start station id": "INTEGER",
+    "start station name": "VARCHAR",
+    "start station latitude": "DOUBLE PRECISION",
+    "start station longitude": "DOUBLE PRECISION",
+    "end station id": "INTEGER",
+    "end station name": "VARCHAR",
+    "end station latitude": "DOUBLE PRECISION",
+    "end station longitude": "DOUBLE PRECISION",
+    "bikeid": "INTEGER",
+    "usertype": "VARCHAR",
+    "birth year": "INTEGER",
+    "gender": "INTEGER"
+    }
+
+#Path of the unzip command line tool, if installed. Without it, the zipped csv files are decompressed by zipfile
+
+UNZIP = find_executable("unzip")
+
+
+connection_pool = None
 
 
 """
-Function used to create connection to postgresql database through the psycopg2 module. Credentials are assumed to be 
-set as environmental variables.
+Function used to create the pool of connections to the postgresql database through the psycopg2 module. Credentials
+are assumed to be set as environmental variables. The pool is kept at module level so that each worker loading a month
+can pull its own connection from it through get_conn. ThreadedConnectionPool raises rather than waits when it runs out
+of connections, so it is sized from max_workers: one connection per load worker, one held by main, and one for the
+first month, which load_months loads on its own while main holds its connection.
 """
-def connect_to_postgresql():
+def connect_to_postgresql(max_workers):
+
+    global connection_pool
 
     postgres_user = os.getenv('POSTGRES_USER', 'default')
     postgres_pass = os.getenv('POSTGRES_PASS', 'default')
     postgres_dbname = os.getenv('POSTGRES_DBNAME', 'default')
 
     try:
-        conn = psycopg2.connect(user=postgres_user, password=postgres_pass, dbname=postgres_dbname)
+        connection_pool = pool.ThreadedConnectionPool(minconn=2, maxconn=max_workers + 2, user=postgres_user, password=postgres_pass, dbname=postgres_dbname)
     except:
         print "psycopg2 cannot connect to postgres database"
         return -1
 
-    return conn
+    return connection_pool
+
+
+"""
+Context manager that borrows a connection from the pool and always hands it back, even if the caller raises.
+"""
+@contextmanager
+def get_conn():
+
+    conn = connection_pool.getconn()
+
+    try:
+        yield conn
+    finally:
+        connection_pool.putconn(conn)
 
 
 """
 Function used to create connection to citibike s3 bucket. Because this is a public dataset, there is no need for
-credentials. Therefore, the s3 client is set to disable_signing, defined by the botocore module
+credentials. Therefore, the s3 client is set to disable_signing, defined by the botocore module. Each call builds its
+resource from a new boto3 session, so that it can be used from its own thread
 """
 def connect_to_public_s3(bucket):
 
-    s3 = boto3.resource('s3')
+    s3 = boto3.session.Session().resource('s3')
     s3.meta.client.meta.events.register('choose-signer.s3.*', disable_signing)
     
     try:
@@ -51,324 +104,433 @@ def connect_to_public_s3(bucket):
 
 
 """
-data_for_month gets a copy of the bike data in the s3 bucket according to the bucket key's dated name, reads it into memory,
-uncompresses the data if it is zipped, reads the corresponding files within the unzipped object (In this exercise, there
-is always one csv file, but the algorithm allows for the possibility that there are more), creates a postgres table 
-(if it doesn't already exist) and copies the data into the table. The copy_from function performs the best with reading
-in large delimited files
+fetch_month gets a copy of the bike data in the s3 bucket according to the bucket key's dated name, and downloads it
+into a named temporary file (so that only a chunk at a time is held in memory, and unzip can read it by its path).
+It is run from a thread pool in load_months, so that the s3 downloads of several months overlap. Each call uses its
+own s3 bucket resource, as boto3 resources are not safe to share across threads. The zipped data is returned as a
+ZipFile.
 """
-def data_for_month(month, table_name, checked_table_exists, s3_bucket, bucket_key_format, conn):
+def fetch_month(year, month, bucket, bucket_key_format):
 
-    cur = conn.cursor()
+    s3_bucket = connect_to_public_s3(bucket)
+
+    if s3_bucket == -1:
+        return -1
+
+    bucket_key = bucket_key_format % (year, month)
+
+    bike_data = tempfile.NamedTemporaryFile(suffix=".zip")
 
-    bucket_key = bucket_key_format % (month)
-        
     try:
-        file_object = s3_bucket.Object(bucket_key)
+        s3_bucket.Object(bucket_key).download_fileobj(bike_data)
     except:
         print "s3 bucket does not contain key: " + bucket_key
-        return (checked_table_exists, -1)
+        bike_data.close()
+        return -1
 
-    if 'Body' in file_object.get():
-        file_object_body = file_object.get()['Body']
-    else:
-        print "Body not found in file object: " + bucket_key 
-        return (checked_table_exists, -1)
+    bike_data.seek(0)
 
-    #Write bucket key data into stringIO to go through files in memory
+    if not zipfile.is_zipfile(bike_data):
+        print "Bucket key data is not a zip file: " + bucket_key
+        bike_data.close()
+        return -1
 
-    bike_data = StringIO()
-    bike_data.write(file_object_body.read())
+    return zipfile.ZipFile(bike_data)
 
-    if zipfile.is_zipfile(bike_data):
-        bike_data = zipfile.ZipFile(bike_data)
 
-    for bike_data_file in bike_data.namelist():
+"""
+load_month reads the files within the unzipped object returned by fetch_month (In this exercise, there is always one
+csv file, but the algorithm allows for the possibility that there are more), creates a postgres table (if it doesn't
+already exist) and copies the data into the table. The table is partitioned by month on starttime. The data of the
+month starting on month_start is copied into a table of its own, created along with it, which is then attached to
+the table as the partition of that month. Each csv is decompressed by a separate unzip process, whose output
+copy_expert streams straight into postgres, which also skips the header row itself. This keeps the decompression out
+of the python interpreter, and lets it run alongside the network send. If unzip is not installed, the zipfile stream
+of the csv is handed to copy_expert directly. The whole month, including the creation of its table and its
+attachment as a partition, is loaded in a single transaction, committed once at the end. Postgres can then skip
+writing the copied rows to the WAL (with wal_level=minimal), as the table was created in the same transaction
+"""
+def load_month(bike_data, table_name, month_start, conn):
 
-        try:
-            data_csv = bike_data.open(bike_data_file)
-        except:
-            continue
+    cur = conn.cursor()
 
-        #Get the first row to get column names, if creating the table for the first time,
-        #or, to get the data_reader to skip the first row for reading in the data
+    copy_table_name = month_partition_name(table_name, month_start)
 
-        data_reader = csv.reader(data_csv, delimiter=',')
-        title_row = data_reader.next()
+    tables_created = False
 
-        if not title_row:
-            continue
+    try:
+
+        #Settings for bulk loading, which only last until the transaction of the month is committed
+
+        cur.execute("SET LOCAL synchronous_commit = OFF; SET LOCAL work_mem = '256MB';")
+
+        for bike_data_file in bike_data.namelist():
+
+            #Get the first row to get column names, for creating the table if it doesn't already exist.
+            #The csv is then decompressed again from the start by unzip, as postgres skips the header row while copying
+
+            try:
+                with bike_data.open(bike_data_file) as title_csv:
+                    title_row = next(csv.reader(title_csv, delimiter=','), None)
+            except:
+                continue
+
+            if not title_row:
+                continue
+
+            #Along with the first file, create the table (if it doesn't already exist) and the table of the month
+
+            if not tables_created:
+
+                create_trip_fact_table(title_row, table_name, conn, partition_column="starttime")
 
-        #Postgres method for checking existence of tables. 
+                create_month_table(table_name, month_start, "starttime", conn)
 
-        if not checked_table_exists:
+                tables_created = True
 
-            check_table_sql = "SELECT 1 FROM pg_tables WHERE tablename = %s;"
+            #The citibike csv files quote every field, including the NULL of a missing station id, so FORCE_NULL is
+            #needed for the typed columns to read it as a NULL rather than fail to parse it
 
-            cur.execute(check_table_sql, (table_name,))
-            
-            if cur.fetchone() == None:
-                create_trip_fact_table(title_row, table_name, conn)
+            typed_columns = [sql.Identifier(column_title) for column_title in title_row
+                if TRIP_FACT_COLUMN_TYPES.get(column_title, "VARCHAR") != "VARCHAR"]
 
-            checked_table_exists = True
-        
-        cur.copy_from(data_csv,table_name,sep=',')
+            sql_composable_array = [sql.Identifier(copy_table_name)]
+            copy_string = "COPY {} FROM STDIN WITH (FORMAT CSV, HEADER TRUE, NULL 'NULL'"
+
+            if typed_columns:
+                sql_composable_array.append(sql.SQL(", ").join(typed_columns))
+                copy_string += ", FORCE_NULL ({})"
+
+            copy_sql = sql.SQL(copy_string + ");").format(*sql_composable_array)
+
+            #close_fds keeps unzip from inheriting the pipes of the unzip processes of other load threads, which would
+            #hold their copy_expert back from reaching the end of its csv until every other unzip had also exited
+
+            if UNZIP:
+                unzip = subprocess.Popen([UNZIP, "-p", bike_data.filename, bike_data_file], stdout=subprocess.PIPE, close_fds=True)
+                data_csv = unzip.stdout
+            else:
+                unzip = None
+                data_csv = bike_data.open(bike_data_file)
+
+            #COPY fails on any value that does not parse as its column type (e.g. a malformed timestamp), or on a row
+            #outside the month, through the CHECK constraint of the month's table. If the COPY does not go through,
+            #unzip is stopped rather than left writing to a pipe nobody reads
+
+            copied = False
+
+            try:
+                cur.copy_expert(copy_sql, data_csv)
+                copied = True
+            except psycopg2.Error as copy_error:
+                print "Cannot copy " + bike_data_file + " into " + copy_table_name + ": " + str(copy_error).strip()
+            finally:
+                if unzip and not copied:
+                    unzip.kill()
+                data_csv.close()
+                if unzip:
+                    unzip.wait()
+
+            if not copied:
+                conn.rollback()
+                return -1
+
+            if unzip and unzip.returncode != 0:
+                print "unzip failed to decompress: " + bike_data_file
+                conn.rollback()
+                return -1
+
+        if tables_created:
+            attach_month_partition(table_name, month_start, conn)
 
         conn.commit()
 
-    return (checked_table_exists, 0)
+    finally:
+        close_month(bike_data)
+
+    return 0
 
 
 """
-Called by the data_for_month function, create_trip_fact_table is called if the table (either trip_fact or
-trip_fact_stg) does not exist. Using the sql.Identifier function to guard the table identfier names (i.e. 
-column names, table names) against SQL injection, the table is created, getting the column names from
-the title row in the csv file. Because we are not assuming we have knowledge of all the column names 
-of the csv file, by default the columns are cast as type CHAR
+close_month closes the ZipFile returned by fetch_month, along with its temporary file, which deletes it. ZipFile.close
+does not close a file object passed to it, so the temporary file is closed on its own
 """
-def create_trip_fact_table(title_row, table_name, conn):
+def close_month(bike_data):
+
+    month_file = bike_data.fp
+
+    bike_data.close()
+    month_file.close()
+
+
+"""
+Called by the load_month function, create_trip_fact_table creates the table with CREATE TABLE IF NOT EXISTS, so
+that no separate round-trip is needed to check whether it already exists. Using the sql.Identifier function to guard
+the table identfier names (i.e. column names, table names) against SQL injection, the table is created, getting the
+column names from the title row in the csv file. Columns found in column_types are declared with their postgres type, so that 
+COPY parses the csv into typed values on the server. Because we are not assuming we have knowledge of all the
+column names of the csv file, any other column is cast as type VARCHAR. If partition_column is given, the table is
+partitioned by range on that column, and the data itself goes into the partitions made by create_month_table.
+The table is not committed here, but along with the data copied into it by load_month
+"""
+def create_trip_fact_table(title_row, table_name, conn, column_types=TRIP_FACT_COLUMN_TYPES, partition_column=None):
 
     cur = conn.cursor()
 
     sql_identifier_array = [sql.Identifier(table_name)]
-    create_table_string = "CREATE TABLE {} ("
+    create_table_string = "CREATE TABLE IF NOT EXISTS {} ("
 
     for column_title in title_row: 
         sql_identifier_array.append(sql.Identifier(column_title))
-        create_table_string += "{} VARCHAR,"
+        create_table_string += "{} " + column_types.get(column_title, "VARCHAR") + ","
 
-    create_table_string = create_table_string[:-1]+");"
+    create_table_string = create_table_string[:-1]+")"
 
-    cur.execute(sql.SQL(create_table_string).format(*sql_identifier_array))
+    if partition_column:
+        sql_identifier_array.append(sql.Identifier(partition_column))
+        create_table_string += " PARTITION BY RANGE ({})"
 
-    conn.commit()
+    create_table_string += ";"
+
+    cur.execute(sql.SQL(create_table_string).format(*sql_identifier_array))
 
 
 """
-Select_from_table is used whenever a function needs to iterate through the results of a select statement.
-SQL query is composed by using the sql.Identifier function for the table names and fields. The position of
-the table names within the query are returned as a dictionary, id_idx (identifier_index), to parse through 
-the returned rows. The first row and the cursor are also returned.
+Name of the partition of table_name holding the month starting on month_start, e.g. trip_fact_2018_01
 """
-def select_from_table(cur, id_names, fetch_sql):
-
-    id_idx = {id_names[i]: i for i in range(len(id_names))}
+def month_partition_name(table_name, month_start):
 
-    sql_identifier_array = [sql.Identifier(name) for name in id_names]
+    return "%s_%d_%.02d" % (table_name, month_start.year, month_start.month)
 
-    cur.execute(sql.SQL(fetch_sql).format(*sql_identifier_array))
 
-    row = cur.fetchone()
+"""
+First day of the month following the month starting on month_start, which is the upper bound of its partition
+"""
+def month_end(month_start):
 
-    return (id_idx, row, cur)
+    return date(month_start.year + month_start.month // 12, month_start.month % 12 + 1, 1)
 
 
 """
-extract_from_trip_fact creates a dictionary that uses the station pair as a key, and the number
-of trips between that pair as the value. Station pairs are first assembled using their ids, and a map
-of the ids to the names is also created. If there are multiple stations assigned to an id, only the first one
-is kept. A final dictionary is created that uses the station names as the key, and is assigned two values:
-the first is an initialization, declaring that the station pair is not already in most_used_routes. The
-second is the number of trips.
+create_month_table creates the table holding the month starting on month_start, named after its partition of
+table_name, with the same columns as table_name. It is created as a plain table rather than as a partition, since
+CREATE TABLE ... PARTITION OF takes an ACCESS EXCLUSIVE lock on table_name, which would be held for the whole COPY and
+keep the months from being copied in concurrently. A CHECK constraint matching the bounds of the partition is added,
+so that attach_month_partition does not need to scan the table. As with create_trip_fact_table, the table is committed
+by load_month along with its data
 """
-def extract_from_trip_fact(table_name, conn):
+def create_month_table(table_name, month_start, partition_column, conn):
 
-    #Indices of start and end station within tuple key
-    START_STATION = 0
-    END_STATION = 1
+    cur = conn.cursor()
 
-    total = {}
-    names = {}
-    total_names = {}
+    partition_name = month_partition_name(table_name, month_start)
 
-    id_names = [
-        "start station id",
-        "start station name",
-        "end station id",
-        "end station name",
-        table_name
-        ]
+    cur.execute(sql.SQL("CREATE TABLE {} (LIKE {}, CONSTRAINT {} CHECK ({} IS NOT NULL AND {} >= {} AND {} < {}));").format(
+        sql.Identifier(partition_name),
+        sql.Identifier(table_name),
+        sql.Identifier(partition_name + "_bounds"),
+        sql.Identifier(partition_column),
+        sql.Identifier(partition_column),
+        sql.Literal(month_start.isoformat()),
+        sql.Identifier(partition_column),
+        sql.Literal(month_end(month_start).isoformat())))
 
-    fetch_sql = "SELECT {}, {}, {}, {} FROM {};"
 
-    id_idx, row, cur = select_from_table(conn.cursor(), id_names, fetch_sql)
+"""
+attach_month_partition attaches the table made by create_month_table to table_name, once its data is copied in, as the
+partition for the month starting on month_start. On postgres 12 and later, ATTACH PARTITION only takes a SHARE UPDATE
+EXCLUSIVE lock on table_name, and thanks to the CHECK constraint it does not scan the table, so the lock is only held
+for the moment before load_month commits. Each month being its own table, a month can also be dropped on its own.
+The CHECK constraint is dropped afterwards, being implied by the partition bounds
+"""
+def attach_month_partition(table_name, month_start, conn):
 
-    #id_idx (identifier index) maps the column name the position of column within the row
-    #Populate the total dictionary with station pair tuples, with values set to number of trips
+    cur = conn.cursor()
 
-    while row:
-        if (row[id_idx["start station id"]], row[id_idx["end station id"]]) not in total:
-            
-            total[ (row[id_idx["start station id"]], row[id_idx["end station id"]]) ] = 1
-        else:
-            total[ (row[id_idx["start station id"]], row[id_idx["end station id"]]) ] += 1
+    partition_name = month_partition_name(table_name, month_start)
 
+    cur.execute(sql.SQL("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({});").format(
+        sql.Identifier(table_name),
+        sql.Identifier(partition_name),
+        sql.Literal(month_start.isoformat()),
+        sql.Literal(month_end(month_start).isoformat())))
 
-        #Create a dictionary that maps station id to station name
+    cur.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {};").format(
+        sql.Identifier(partition_name),
+        sql.Identifier(partition_name + "_bounds")))
 
-        if row[id_idx["start station id"]] not in names:
 
-            names[row[id_idx["start station id"]]] = row[id_idx["start station name"]]
+"""
+merge_most_used_routes counts the trips between each station pair of table_name within postgres, and merges the counts
+into most_used_routes in a single statement. New station pairs are inserted, and pairs already in most_used_routes
+have the new trips added to their num_trips, through the UNIQUE constraint on the station pair. No trip rows
+leave the database.
+"""
+def merge_most_used_routes(table_name, conn):
 
-        if row[id_idx["end station id"]] not in names:
+    cur = conn.cursor()
 
-            names[row[id_idx["end station id"]]] = row[id_idx["end station name"]]
+    merge_sql = (
+        "INSERT INTO most_used_routes (start_station_name, end_station_name, num_trips) "
+        "SELECT {}, {}, COUNT(*) FROM {} GROUP BY 1, 2 "
+        "ON CONFLICT (start_station_name, end_station_name) "
+        "DO UPDATE SET num_trips = most_used_routes.num_trips + EXCLUDED.num_trips;"
+        )
 
-        row = cur.fetchone()
+    cur.execute(sql.SQL(merge_sql).format(
+        sql.Identifier("start station name"),
+        sql.Identifier("end station name"),
+        sql.Identifier(table_name)))
 
+    conn.commit()
 
-    #Map station ids within key tuples to station names.
-    #route_id in value pair initialized to None (Later used to check against most_used_routes)
-    #Second element in value pair is total number of trips
 
-    for key in total:
-        if (names[key[START_STATION]], names[key[END_STATION]]) not in total_names:
+"""
+Worker run by the load thread pool in load_months. Every worker uses its own pooled postgres connection.
+"""
+def load_month_worker(bike_data, table_name, month_start):
 
-            total_names[ (names[key[START_STATION]], names[key[END_STATION]]) ] = {'route_id': None, 'num_trips': total[key]}            
-        else:
-            total_names[ (names[key[START_STATION]], names[key[END_STATION]]) ]['num_trips'] +=  total[key]
+    with get_conn() as conn:
+        retval = load_month(bike_data, table_name, month_start, conn)
 
-    return total_names
+    return retval
 
 
 """
-A hint towards distributed computing: In this script, most_used_routes is read into memory
-to check against the new month's trips between station pairs within a dictionary. If this project were to
-scale up, mapReduce can be used to reduce the old trip data and new incoming data by key, and add their
-values. In this case, it is done serially. 
+load_months downloads the given months concurrently with fetch_month, and hands each month to load_month as soon as
+its download completes, waiting on the downloads and the loads together so that a failure of either is seen at once. The first month to arrive is loaded on its own, so that the table is created before the
+other months are loaded concurrently (CREATE TABLE IF NOT EXISTS can still fail when run at the same time by two
+sessions), each on a dedicated connection from the pool. Each month is loaded into its own partition of the table.
+As soon as a month fails, the downloads and loads that have not started yet are cancelled, and the months that were
+downloaded but not loaded are closed, through cancel_months.
 """
-def reduceByKey_most_used_routes(total_names, conn):
+def load_months(year, months, table_name, bucket, bucket_key_format, max_workers):
 
-    id_names = [
-        "route_id",
-        "start_station_name",
-        "end_station_name",
-        "num_trips"
-        ]
+    first_load = True
+    handed_fetches = set()
+    loads = {}
+    loaded = False
 
-    fetch_sql = "SELECT {}, {}, {}, {} FROM most_used_routes;"
-    
-    id_idx, row, cur = select_from_table(conn.cursor(), id_names, fetch_sql)
+    with ThreadPoolExecutor(max_workers=max_workers) as fetch_executor, \
+            ThreadPoolExecutor(max_workers=max_workers) as load_executor:
 
+        fetches = {fetch_executor.submit(fetch_month, year, month, bucket, bucket_key_format): month for month in months}
 
-    #If the station pair in the dictionary matches the station pair in most_used_routes, 
-    #set the route_id element of the dictionary value to the route_id value in most_used_routes,
-    #and update the dictionary value of the number of trips
+        pending = set(fetches)
 
-    while row:
-        if (row[id_idx["start_station_name"]], row[id_idx["end_station_name"]]) in total_names:
+        try:
+            while pending:
 
-            total_names[ (row[id_idx["start_station_name"]], row[id_idx["end_station_name"]]) ]["route_id"] = row[id_idx["route_id"]] 
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
 
-            total_names[ (row[id_idx["start_station_name"]], row[id_idx["end_station_name"]]) ]["num_trips"] += row[id_idx["num_trips"]] 
+                for future in done:
 
-        row = cur.fetchone()
+                    if future in loads:
 
+                        if future.result() == -1:
+                            return -1
 
-"""
-If the only_insert option is true (as would be the case after only reading in the older months), the trip data is inserted 
-into most_used_routes from the data dictionary. If it is set false, then depending on whether the station pair key is
-already in most_used_routes, the new data is either inserted into the table as a new row and new station pair, or is used 
-to update the old data. Determining whether to INSERT or UPDATE within the python script performs much better than
-using 'UPSERT" methods within SQL
-"""
-def modify_most_used_routes(total_names, only_insert, conn):
+                        continue
 
-    #Indices of start and end station within tuple key
-    START_STATION = 0   
-    END_STATION = 1
+                    bike_data = future.result()
 
-    cur = conn.cursor()
+                    if bike_data == -1:
+                        return -1
 
-    insert_sql = "INSERT INTO most_used_routes (start_station_name, end_station_name, num_trips) VALUES ( %s,%s,%s);"
+                    handed_fetches.add(future)
 
-    if only_insert:
-        insert_array = [(key[START_STATION], key[END_STATION], total_names[key]["num_trips"]) for key in total_names]
-    else:
-        insert_array = []
-        update_array = []
-        
-        for key in total_names:
-            if total_names[key]["route_id"] == None:
+                    month_start = date(year, fetches[future], 1)
 
-                insert_array.append( (key[START_STATION], key[END_STATION], total_names[key]["num_trips"]) )
-            else:
-                update_array.append( (total_names[key]["num_trips"], total_names[key]["route_id"]) )
+                    if first_load:
+                        with get_conn() as conn:
+                            retval = load_month(bike_data, table_name, month_start, conn)
 
-        update_sql = "UPDATE most_used_routes SET num_trips = %s WHERE route_id = %s;"
+                        if retval == -1:
+                            return -1
 
-        extras.execute_batch(cur,update_sql, update_array)           
-    
-    extras.execute_batch(cur,insert_sql, insert_array)           
+                        first_load = False
+                    else:
+                        load = load_executor.submit(load_month_worker, bike_data, table_name, month_start)
+                        loads[load] = bike_data
+                        pending.add(load)
 
-    conn.commit()
+            loaded = True
 
+        finally:
+            if not loaded:
+                cancel_months(fetches, handed_fetches, loads)
 
-def main(*argv):
+    return 0
 
-    #The initial options. Future implementation can have these options read in argv, or as a input JSON file 
- 
-    bucket = "tripdata"
-    bucket_key_format = "2018%.02d-citibike-tripdata.csv.zip"
-    first_month = 1
-    last_month = 7
 
-    conn = connect_to_postgresql()
-    
-    if conn == -1:
-        return -1
+"""
+cancel_months is called by load_months when a month fails. The downloads and loads that have not started yet are
+cancelled, and the ZipFiles of the months that were downloaded but not handed to load_month, or whose load was
+cancelled, are closed with close_month. Downloads already running cannot be cancelled, and are waited for so that
+their ZipFiles can be closed as well
+"""
+def cancel_months(fetches, handed_fetches, loads):
 
-    cur = conn.cursor()
+    for fetch in fetches:
 
-    s3_bucket = connect_to_public_s3(bucket)
+        if fetch in handed_fetches or fetch.cancel():
+            continue
 
-    if s3_bucket == -1:
-        return -1
+        if fetch.exception() is None and fetch.result() != -1:
+            close_month(fetch.result())
 
-    #1. Read in citibike data from January 2018 to June 2018
+    for load in loads:
 
-    checked_table_exists = False
+        if load.cancel():
+            close_month(loads[load])
 
-    for month in range(first_month, last_month):
-        checked_table_exists, retval = data_for_month(month, "trip_fact", checked_table_exists, s3_bucket, bucket_key_format, conn)
 
-        if retval == -1:
-            return -1
+def main(*argv):
 
+    #The initial options. Future implementation can have these options read in argv, or as a input JSON file 
+ 
+    bucket = "tripdata"
+    bucket_key_format = "%d%.02d-citibike-tripdata.csv.zip"
+    year = 2018
+    first_month = 1
+    last_month = 7
+    max_workers = 6
 
-    #2. Create most_used_routes and insert the data from the older months. (The station pairs are not symmetric)
+    if connect_to_postgresql(max_workers) == -1:
+        return -1
 
-    cur.execute("CREATE TABLE most_used_routes (route_id serial PRIMARY KEY, start_station_name VARCHAR, end_station_name VARCHAR, num_trips INTEGER);")
-    conn.commit()
+    try:
 
-    total_names = extract_from_trip_fact("trip_fact", conn)
+        #1. Read in citibike data from January 2018 to June 2018, each month into its own partition of trip_fact
 
+        if load_months(year, range(first_month, last_month), "trip_fact", bucket, bucket_key_format, max_workers) == -1:
+            return -1
 
-    #Since there is no data to update, set only_insert to TRUE in modify_most_used_routes
+        with get_conn() as conn:
 
-    modify_most_used_routes(total_names, True, conn)
+            cur = conn.cursor()
 
+            #2. Create most_used_routes and insert the data from the older months. (The station pairs are not symmetric)
 
-    #3. Read in citibike data from July 2017
+            cur.execute("CREATE TABLE most_used_routes (route_id serial PRIMARY KEY, start_station_name VARCHAR, end_station_name VARCHAR, num_trips INTEGER, UNIQUE (start_station_name, end_station_name));")
+            conn.commit()
 
-    _, retval = data_for_month(last_month, "trip_fact_stg", False, s3_bucket, bucket_key_format, conn)
+            merge_most_used_routes("trip_fact", conn)
 
-    if retval == -1:
-        return -1
 
+            #3. Read in citibike data from July 2018, into its own partition of trip_fact
 
-    #4. Update most_used_routes with the new data
+            if load_months(year, [last_month], "trip_fact", bucket, bucket_key_format, max_workers) == -1:
+                return -1
 
-    total_names = extract_from_trip_fact("trip_fact_stg", conn)
 
-    #Using older month data, update total_names dictionary, with station pair keys and route-trip values, in reduceByKey_most_used_routes
-    #Insert new pairs and update old ones in modify_most_used_routes (only_insert set FALSE)
+            #4. Update most_used_routes with the new data from the July partition only: new station pairs are inserted,
+            #and old ones have their trips added
 
-    reduceByKey_most_used_routes(total_names, conn)
+            merge_most_used_routes(month_partition_name("trip_fact", date(year, last_month, 1)), conn)
 
-    modify_most_used_routes(total_names, False, conn)
+    finally:
+        connection_pool.closeall()
 
-    conn.close()
-    
 if __name__=="__main__":
     main(*sys.argv)